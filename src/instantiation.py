@@ -2,149 +2,185 @@
 # Given a view hierarchy, generate constraint sketches with unknown parameters.
 # Uses vectorized matrix operations to efficiently identify valid anchor pairs.
 
+from itertools import pairwise
+from typing import NamedTuple
+
 import numpy as np
-from intervaltree import IntervalTree
 
 from src.types import Anchor, LinearConstraint, View
 
+# Integer codes for anchor types, in the order View.anchors() creates them
+ANCHOR_TYPE_CODES = {
+    "left": 0,
+    "right": 1,
+    "top": 2,
+    "bottom": 3,
+    "center_x": 4,
+    "center_y": 5,
+    "width": 6,
+    "height": 7,
+}
+
+
+class SweepEdge(NamedTuple):
+    """
+    A view edge crossed by a sweep line, with its matrix indices resolved.
+    """
+
+    view: View
+    index: int  # Matrix index of the edge anchor
+    center_index: int  # Matrix index of the view's center anchor
+
+
+def index_anchors(anchors: list[Anchor]) -> dict[tuple[str, str], int]:
+    """Index anchors by view name and type, which is preserved across examples."""
+    return {(anchor.view.name, anchor.type): i for i, anchor in enumerate(anchors)}
 
-def compute_visibility_matrix(anchors: list[Anchor], root: View) -> np.ndarray:
+
+def compute_visibility_matrix(
+    anchors: list[Anchor],
+    root: View,
+    visible_matrix: np.ndarray | None = None,
+    anchor_to_index_map: dict[tuple[str, str], int] | None = None,
+) -> np.ndarray:
     """
-    Compute NxN visibility matrix using sweep-line algorithm with IntervalTree.
+    Compute NxN visibility matrix using sweep-line algorithm.
 
     Algorithm:
-    1. Build interval trees for horizontal/vertical edges
+    1. Collect horizontal/vertical edges and their extents
     2. Cast sweep lines at every view boundary coordinate
     3. Edges adjacent along a sweep line are visible to each other
+
+    If visible_matrix is given, visible pairs are marked in it in place and it
+    is returned, which lets callers union several examples into one buffer.
+    anchor_to_index_map (see index_anchors) can likewise be built once and
+    shared across examples.
     """
     n = len(anchors)
-    visible_matrix = np.zeros((n, n), dtype=bool)
-
-    # Index anchors by view and type to preserve across examples
-    anchor_to_index_map = {
-        (anchor.view.name, anchor.type): i for i, anchor in enumerate(anchors)
-    }
+    if visible_matrix is None:
+        visible_matrix = np.zeros((n, n), dtype=bool)
 
-    # Stores horizontal edges of the form y = c {left <= x <= right}
-    # When queried by x = c, returns intersecting edges
-    horizontal_edge_tree = IntervalTree()
-    # Stores vertical edges of the form x = c {top <= y <= bottom}
-    # When queried by y = c, returns intersecting edges
-    vertical_edge_tree = IntervalTree()
+    if anchor_to_index_map is None:
+        anchor_to_index_map = index_anchors(anchors)
 
     # Don't consider root view since it always intersects with all other views
-    views = [v for v in root._flattened_views_in_subtree if v != root]
+    views = [v for v in root._flattened_views_in_subtree if v is not root]
+    # One column per rect coordinate (left, top, right, bottom) of each view
+    rects = np.array([view.rect for view in views], dtype=np.float64).reshape(-1, 4)
 
     # Collect all y-coords to cast horizontal intersection lines y = c
-    horizontal_events = set()
-    # Collect all x-coords to cast vertical intersection lines x = c
-    vertical_events = set()
-
+    # and all x-coords to cast vertical intersection lines x = c.
     # Add sweep lines at root's edges in case some children are touching
-    horizontal_events.add(root.rect[1])  # top
-    horizontal_events.add(root.rect[3])  # bottom
-    vertical_events.add(root.rect[0])  # left
-    vertical_events.add(root.rect[2])  # right
+    horizontal_events = np.unique(
+        np.concatenate((rects[:, 1], rects[:, 3], root.rect[1::2]))
+    )
+    vertical_events = np.unique(
+        np.concatenate((rects[:, 0], rects[:, 2], root.rect[0::2]))
+    )
 
-    for view in views:
-        left, top, right, bottom = view.rect
-        # Top edge
-        horizontal_edge_tree.addi(begin=left, end=right, data=view.anchor("top"))
-        # Bottom edge
-        horizontal_edge_tree.addi(begin=left, end=right, data=view.anchor("bottom"))
-
-        horizontal_events.add(top)
-        horizontal_events.add(bottom)
-
-        # Left edge
-        vertical_edge_tree.addi(begin=top, end=bottom, data=view.anchor("left"))
-        # Right edge
-        vertical_edge_tree.addi(begin=top, end=bottom, data=view.anchor("right"))
-
-        vertical_events.add(left)
-        vertical_events.add(right)
-
-    for vertical_line in vertical_events:
-        intersecting_anchors: list[Anchor] = [
-            interval.data for interval in horizontal_edge_tree[vertical_line]
-        ]
-        # Original Mockdown sorts by view.center_y, then by anchor position
-        intersecting_anchors.sort(
-            key=lambda anchor: (
-                (anchor.view.rect[1] + anchor.view.rect[3]) / 2,  # view.center_y
-                (
-                    anchor.view.rect[1] if anchor.type == "top" else anchor.view.rect[3]
-                ),  # position
-            )
+    def sweep_edge(view: View, type: str, center_type: str) -> SweepEdge:
+        return SweepEdge(
+            view=view,
+            index=anchor_to_index_map[(view.name, type)],
+            center_index=anchor_to_index_map[(view.name, center_type)],
         )
 
-        # Root edges will always start and end the intersecting anchors
-        intersecting_anchors.insert(0, root.anchor("top"))
-        intersecting_anchors.append(root.anchor("bottom"))
+    # Horizontal edges of the form y = c {left <= x < right}, top then bottom
+    # of each view, and vertical edges of the form x = c {top <= y < bottom},
+    # left then right of each view
+    horizontal_edges: list[SweepEdge] = []
+    vertical_edges: list[SweepEdge] = []
+    for view in views:
+        horizontal_edges.append(sweep_edge(view, "top", "center_y"))
+        horizontal_edges.append(sweep_edge(view, "bottom", "center_y"))
+        vertical_edges.append(sweep_edge(view, "left", "center_x"))
+        vertical_edges.append(sweep_edge(view, "right", "center_x"))
+
+    # Original Mockdown sorts the edges on a sweep line by view center, then by
+    # anchor position. Sorting all edges once (stably, so ties stay in pre-order,
+    # parents before children) leaves the edges hit by any line in that order
+    # (np.lexsort takes its keys least significant first)
+    horizontal_order = np.lexsort(
+        (rects[:, 1::2].ravel(), np.repeat((rects[:, 1] + rects[:, 3]) / 2, 2))
+    )
+    horizontal_edges = [horizontal_edges[k] for k in horizontal_order]
+    horizontal_begins = np.repeat(rects[:, 0], 2)[horizontal_order]
+    horizontal_ends = np.repeat(rects[:, 2], 2)[horizontal_order]
+
+    vertical_order = np.lexsort(
+        (rects[:, 0::2].ravel(), np.repeat((rects[:, 0] + rects[:, 2]) / 2, 2))
+    )
+    vertical_edges = [vertical_edges[k] for k in vertical_order]
+    vertical_begins = np.repeat(rects[:, 1], 2)[vertical_order]
+    vertical_ends = np.repeat(rects[:, 3], 2)[vertical_order]
+
+    # Intersections of every sweep line with every edge, one row per line
+    # x = c (resp. y = c); half-open like an interval tree point query
+    vertical_line_hits = (horizontal_begins <= vertical_events[:, None]) & (
+        vertical_events[:, None] < horizontal_ends
+    )
+    horizontal_line_hits = (vertical_begins <= horizontal_events[:, None]) & (
+        horizontal_events[:, None] < vertical_ends
+    )
+
+    # Root edges, which start and end every sweep line
+    root_top_edge = sweep_edge(root, "top", "center_y")
+    root_bottom_edge = sweep_edge(root, "bottom", "center_y")
+    root_left_edge = sweep_edge(root, "left", "center_x")
+    root_right_edge = sweep_edge(root, "right", "center_x")
+
+    # Adjacent edge pairs from every sweep line. A pair usually stays adjacent
+    # across many lines, so pairs are collected once and marked together
+    adjacent_edges: set[tuple[int, int, int, int]] = set()
+
+    for hits in vertical_line_hits:
+        # Root edges will always start and end the intersecting edges
+        intersecting_edges = (
+            [root_top_edge]
+            + [horizontal_edges[k] for k in np.flatnonzero(hits).tolist()]
+            + [root_bottom_edge]
+        )
 
-        # Adjacent anchors are visible
-        for i in range(len(intersecting_anchors) - 1):
-            anchor_i = intersecting_anchors[i]
-            anchor_j = intersecting_anchors[i + 1]
+        # Adjacent edges are visible
+        for edge_i, edge_j in pairwise(intersecting_edges):
             # We should not have duplicate anchors here
-            assert anchor_i != anchor_j
+            assert edge_i.index != edge_j.index
             # Skip meaningless anchors pairs from same view
-            if anchor_i.view.name == anchor_j.view.name:
+            if edge_i.view is edge_j.view:
                 continue
 
-            # Mark the edge anchors as visible
-            idx_i = anchor_to_index_map[(anchor_i.view.name, anchor_i.type)]
-            idx_j = anchor_to_index_map[(anchor_j.view.name, anchor_j.type)]
-            visible_matrix[idx_i, idx_j] = True
-            visible_matrix[idx_j, idx_i] = True  # Symmetric
-
-            # Also mark center_y anchors of adjacent views as visible
-            center_y_i = anchor_to_index_map[(anchor_i.view.name, "center_y")]
-            center_y_j = anchor_to_index_map[(anchor_j.view.name, "center_y")]
-            visible_matrix[center_y_i, center_y_j] = True
-            visible_matrix[center_y_j, center_y_i] = True
-
-    for horizontal_line in horizontal_events:
-        intersecting_anchors: list[Anchor] = [
-            interval.data for interval in vertical_edge_tree[horizontal_line]
-        ]
-        # Original Mockdown sorts by view.center_x, then by anchor position
-        intersecting_anchors.sort(
-            key=lambda anchor: (
-                (anchor.view.rect[0] + anchor.view.rect[2]) / 2,  # view.center_x
-                (
-                    anchor.view.rect[0]
-                    if anchor.type == "left"
-                    else anchor.view.rect[2]
-                ),  # position
+            # The edge anchors, and the center_y anchors of their views
+            adjacent_edges.add(
+                (edge_i.index, edge_j.index, edge_i.center_index, edge_j.center_index)
             )
-        )
 
-        # Root edges will always start and end the intersecting anchors
-        intersecting_anchors.insert(0, root.anchor("left"))
-        intersecting_anchors.append(root.anchor("right"))
+    for hits in horizontal_line_hits:
+        # Root edges will always start and end the intersecting edges
+        intersecting_edges = (
+            [root_left_edge]
+            + [vertical_edges[k] for k in np.flatnonzero(hits).tolist()]
+            + [root_right_edge]
+        )
 
-        # Adjacent anchors are visible
-        for i in range(len(intersecting_anchors) - 1):
-            anchor_i = intersecting_anchors[i]
-            anchor_j = intersecting_anchors[i + 1]
+        # Adjacent edges are visible
+        for edge_i, edge_j in pairwise(intersecting_edges):
             # We should not have duplicate anchors here
-            assert anchor_i != anchor_j
+            assert edge_i.index != edge_j.index
             # Skip meaningless anchors pairs from same view
-            if anchor_i.view.name == anchor_j.view.name:
+            if edge_i.view is edge_j.view:
                 continue
 
-            # Mark the edge anchors as visible
-            idx_i = anchor_to_index_map[(anchor_i.view.name, anchor_i.type)]
-            idx_j = anchor_to_index_map[(anchor_j.view.name, anchor_j.type)]
-            visible_matrix[idx_i, idx_j] = True
-            visible_matrix[idx_j, idx_i] = True  # Symmetric
+            # The edge anchors, and the center_x anchors of their views
+            adjacent_edges.add(
+                (edge_i.index, edge_j.index, edge_i.center_index, edge_j.center_index)
+            )
 
-            # Also mark center_x anchors of adjacent views as visible
-            center_x_i = anchor_to_index_map[(anchor_i.view.name, "center_x")]
-            center_x_j = anchor_to_index_map[(anchor_j.view.name, "center_x")]
-            visible_matrix[center_x_i, center_x_j] = True
-            visible_matrix[center_x_j, center_x_i] = True
+    # Mark the edge and center anchors of adjacent edges as visible, symmetrically
+    if adjacent_edges:
+        index_i, index_j, center_i, center_j = np.array(list(adjacent_edges)).T
+        rows = np.concatenate((index_i, index_j, center_i, center_j))
+        cols = np.concatenate((index_j, index_i, center_j, center_i))
+        visible_matrix[rows, cols] = True
 
     return visible_matrix
 
@@ -165,22 +201,33 @@ def template_instantiation(examples: list[View]) -> list[LinearConstraint]:
 
     # Use boolean matrices to efficiently combine
     # various predicates over anchor pairs
-    views = np.array([a.view for a in anchors], dtype=object)
-    types = np.array([a.type for a in anchors], dtype=object)
-
-    is_size = np.array([a.is_size() for a in anchors])
-    is_position = np.array([a.is_position() for a in anchors])
-    is_horizontal = np.array([a.is_horizontal() for a in anchors])
-    is_vertical = np.array([a.is_vertical() for a in anchors])
+    # Views and types are integer-coded so that pairwise comparisons
+    # run on contiguous arrays instead of calling View.__eq__ per pair
+    view_index = {
+        id(view): i for i, view in enumerate(examples[0]._flattened_views_in_subtree)
+    }
+    views = np.array([view_index[id(a.view)] for a in anchors])
+    types = np.array([ANCHOR_TYPE_CODES[a.type] for a in anchors])
+
+    # Classify every anchor in a single pass, one row per category
+    # (copied to C order so each row is contiguous for the broadcasts below)
+    is_size, is_position, is_horizontal, is_vertical = np.ascontiguousarray(
+        np.array(
+            [
+                (a.is_size(), a.is_position(), a.is_horizontal(), a.is_vertical())
+                for a in anchors
+            ],
+            dtype=bool,
+        ).T
+    )
 
-    parents = np.array([a.view.parent for a in anchors], dtype=object)
-    children = np.array([set(a.view.children) for a in anchors], dtype=object)
+    # A parent outside of this example (e.g. the root's) is encoded as -1
+    parents = np.array([view_index.get(id(a.view.parent), -1) for a in anchors])
 
     same_view_matrix = views[:, None] == views[None, :]
     same_type_matrix = types[:, None] == types[None, :]
-    parent_matrix = np.vectorize(lambda c, child_set: c in child_set)(
-        views[None, :], children[:, None]
-    )
+    # y's view is the parent of x's view
+    parent_matrix = views[:, None] == parents[None, :]
     sibling_matrix = (views[:, None] != views[None, :]) & (
         parents[:, None] == parents[None, :]
     )
@@ -189,15 +236,20 @@ def template_instantiation(examples: list[View]) -> list[LinearConstraint]:
     both_horizontal_matrix = is_horizontal[:, None] & is_horizontal[None, :]
     both_vertical_matrix = is_vertical[:, None] & is_vertical[None, :]
     one_horizontal_one_vertical_matrix = is_horizontal[:, None] & is_vertical[None, :]
-    dual_type_matrix = ((types[:, None] == "right") & (types[None, :] == "left")) | (
-        (types[:, None] == "bottom") & (types[None, :] == "top")
+    dual_type_matrix = (
+        (types[:, None] == ANCHOR_TYPE_CODES["right"])
+        & (types[None, :] == ANCHOR_TYPE_CODES["left"])
+    ) | (
+        (types[:, None] == ANCHOR_TYPE_CODES["bottom"])
+        & (types[None, :] == ANCHOR_TYPE_CODES["top"])
     )
 
-    # Compute visibility matrix for all examples
+    # Compute visibility matrix for all examples, marking every
+    # example into the same buffer to take their union
     visible_matrix = np.zeros((n, n), dtype=bool)
+    anchor_to_index_map = index_anchors(anchors)
     for example in examples:
-        example_visible_matrix = compute_visibility_matrix(anchors, example)
-        visible_matrix |= example_visible_matrix
+        compute_visibility_matrix(anchors, example, visible_matrix, anchor_to_index_map)
 
     # Aspect Ratio Constraints: (y = a * x)
     # y and x are from same view and y = [anchor].width; x = [anchor].height
@@ -228,30 +280,23 @@ def template_instantiation(examples: list[View]) -> list[LinearConstraint]:
 
     # Compute view-level visibility matrices, which marks an anchor pair as visible if
     # *any anchor pair* of their views were deemed visible by the sweep-line algorithm
-    views = examples[0]._flattened_views_in_subtree
-    for i in range(0, n, 8):
-        view = anchors[i].view
-        assert view == anchors[i + 1].view
-        assert view == anchors[i + 2].view
-        assert view == anchors[i + 3].view
-        assert view == anchors[i + 4].view
-        assert view == anchors[i + 5].view
-        assert view == anchors[i + 6].view
-        assert view == anchors[i + 7].view
-        assert view == views[i // 8]
+    # The reshapes below rely on anchors being grouped 8 per view,
+    # in the same order as the flattened views
+    assert (views == np.arange(n) // 8).all()
 
     h_visible_anchor_matrix = both_horizontal_matrix & visible_matrix
     v_visible_anchor_matrix = both_vertical_matrix & visible_matrix
 
-    # (anchors x anchors) -> (views, anchors, views, anchors)
+    # (anchors x anchors) -> (views, anchors, views, anchors), reduce once per
+    # view pair and then gather back to anchor pairs through the view indices
     h_view_anchor_blocks = h_visible_anchor_matrix.reshape(n // 8, 8, n // 8, 8)
-    h_visible_view_matrix = np.repeat(
-        np.repeat(h_view_anchor_blocks.any(axis=(1, 3)), 8, axis=0), 8, axis=1
-    )
+    h_visible_view_matrix = h_view_anchor_blocks.any(axis=(1, 3))[
+        views[:, None], views[None, :]
+    ]
     v_view_anchor_blocks = v_visible_anchor_matrix.reshape(n // 8, 8, n // 8, 8)
-    v_visible_view_matrix = np.repeat(
-        np.repeat(v_view_anchor_blocks.any(axis=(1, 3)), 8, axis=0), 8, axis=1
-    )
+    v_visible_view_matrix = v_view_anchor_blocks.any(axis=(1, 3))[
+        views[:, None], views[None, :]
+    ]
 
     # Alignment Position Constraints: (y = x)
     # y = [sibling].[left/right]; x = [sibling].[left/right]
@@ -274,32 +319,37 @@ def template_instantiation(examples: list[View]) -> list[LinearConstraint]:
     )
     alignment_matrix = alignment_horizontal_matrix | alignment_vertical_matrix
 
-    for i in range(n):
-        for j in range(n):
-            if aspect_ratio_matrix[i, j]:
-                sketches.append(
-                    LinearConstraint(y=anchors[i], x=anchors[j], a=None, b=0.0),
-                )
-            if parent_relative_matrix[i, j]:
-                sketches.append(
-                    LinearConstraint(
-                        y=anchors[i],
-                        x=anchors[j],
-                        a=None,
-                        b=0.0,
-                    ),
-                )
-            if offset_matrix[i, j] or alignment_matrix[i, j]:
-                # Technically alignment should enfoce b=0, but
-                # original Mockdown allows small alignment errors
-                sketches.append(
-                    LinearConstraint(y=anchors[i], x=anchors[j], a=1.0, b=None),
-                )
+    offset_alignment_matrix = offset_matrix | alignment_matrix
+    sketch_matrix = (
+        aspect_ratio_matrix | parent_relative_matrix | offset_alignment_matrix
+    )
+
+    # Only visit anchor pairs that produce at least one sketch,
+    # in the same row-major order as a full scan over (i, j)
+    for i, j in np.argwhere(sketch_matrix).tolist():
+        if aspect_ratio_matrix[i, j]:
+            sketches.append(
+                LinearConstraint(y=anchors[i], x=anchors[j], a=None, b=0.0),
+            )
+        if parent_relative_matrix[i, j]:
+            sketches.append(
+                LinearConstraint(
+                    y=anchors[i],
+                    x=anchors[j],
+                    a=None,
+                    b=0.0,
+                ),
+            )
+        if offset_alignment_matrix[i, j]:
+            # Technically alignment should enfoce b=0, but
+            # original Mockdown allows small alignment errors
+            sketches.append(
+                LinearConstraint(y=anchors[i], x=anchors[j], a=1.0, b=None),
+            )
 
     # Constant Constraints: (y = b)
     # y = [anchor].width/height
-    for i in range(n):
-        if anchors[i].is_size():
-            sketches.append(LinearConstraint(y=anchors[i], x=None, a=0.0, b=None))
+    for i in np.flatnonzero(is_size).tolist():
+        sketches.append(LinearConstraint(y=anchors[i], x=None, a=0.0, b=None))
 
     return sketches
@@ -1,6 +1,13 @@
+from functools import cached_property
 from typing import Literal, Optional
 
-from pydantic import BaseModel, Field, PrivateAttr
+from pydantic import BaseModel, Field
+
+# Anchor type categories, shared by every Anchor.is_* check
+SIZE_TYPES = frozenset({"width", "height"})
+POSITION_TYPES = frozenset({"left", "top", "right", "bottom", "center_x", "center_y"})
+HORIZONTAL_TYPES = frozenset({"left", "right", "center_x", "width"})
+VERTICAL_TYPES = frozenset({"top", "bottom", "center_y", "height"})
 
 
 class View(BaseModel):
@@ -9,9 +16,6 @@ class View(BaseModel):
     children: list["View"] = Field(default_factory=list)
     parent: Optional["View"] = None
 
-    _anchors_in_subtree: list["Anchor"] = PrivateAttr(default_factory=list)
-    _flattened_views_in_subtree: list["View"] = PrivateAttr(default_factory=list)
-
     def anchor(self, type: str) -> "Anchor":
         return Anchor(view=self, type=type)
 
@@ -24,15 +28,30 @@ class View(BaseModel):
         return self.name == other.name and self.rect == other.rect
 
     def model_post_init(self, _):
-        anchors = self.anchors()
-        views = [self]
+        # Children are validated (and post-initialized) before their parent,
+        # so only the parent links are left to fill in here
         for child in self.children:
             child.parent = self
-            child.model_post_init(_)
-            anchors.extend(child._anchors_in_subtree)
-            views.extend(child._flattened_views_in_subtree)
-        self._anchors_in_subtree = anchors
-        self._flattened_views_in_subtree = views
+
+    @cached_property
+    def _flattened_views_in_subtree(self) -> list["View"]:
+        """Get all views in this subtree in pre-order, starting with this view."""
+        views = []
+        stack = [self]
+        while stack:
+            view = stack.pop()
+            views.append(view)
+            stack.extend(reversed(view.children))
+        return views
+
+    @cached_property
+    def _anchors_in_subtree(self) -> list["Anchor"]:
+        """Get all anchors of the views in this subtree, grouped by view."""
+        return [
+            anchor
+            for view in self._flattened_views_in_subtree
+            for anchor in view.anchors()
+        ]
 
     def anchors(self) -> list["Anchor"]:
         """Get all anchors for this view."""
@@ -75,22 +94,22 @@ class Anchor(BaseModel):
 
     def is_size(self) -> bool:
         """Check if anchor is a size type (width or height)."""
-        return self.type in ["width", "height"]
+        return self.type in SIZE_TYPES
 
     def is_position(self) -> bool:
         """
         Check if anchor is a position type (left, top, right, bottom, center_x,
         center_y).
         """
-        return self.type in ["left", "top", "right", "bottom", "center_x", "center_y"]
+        return self.type in POSITION_TYPES
 
     def is_horizontal(self) -> bool:
         """Check if anchor is a horizontal type (left, right, center_x, width)."""
-        return self.type in ["left", "right", "center_x", "width"]
+        return self.type in HORIZONTAL_TYPES
 
     def is_vertical(self) -> bool:
         """Check if anchor is a vertical type (top, bottom, center_y, height)."""
-        return self.type in ["top", "bottom", "center_y", "height"]
+        return self.type in VERTICAL_TYPES
 
 
 class LinearConstraint(BaseModel):
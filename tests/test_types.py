@@ -0,0 +1,26 @@
+from src.types import View
+
+
+def test_flattened_views_in_subtree_preorder():
+    """Subtree views are listed in pre-order and anchors are grouped by view."""
+    root = View(
+        name="root",
+        rect=(0, 0, 100, 100),
+        children=[
+            {
+                "name": "a",
+                "rect": (0, 0, 50, 100),
+                "children": [{"name": "a1", "rect": (10, 10, 40, 40)}],
+            },
+            {"name": "b", "rect": (50, 0, 100, 100)},
+        ],
+    )
+    views = root._flattened_views_in_subtree
+    assert [v.name for v in views] == ["root", "a", "a1", "b"]
+    assert views[2].parent is views[1]
+    assert views[3].parent is root
+
+    anchors = root._anchors_in_subtree
+    assert len(anchors) == 8 * len(views)
+    for i, anchor in enumerate(anchors):
+        assert anchor.view is views[i // 8]